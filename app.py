@@ -1,114 +1,337 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Flask, render_template, request, redirect, url_for, session, flash, g, abort
+from contextlib import contextmanager
+from functools import wraps
+import atexit
 import sqlite3
 import hashlib
+import hmac
+import queue
+import threading
+from types import MappingProxyType
 import os
 
 app = Flask(__name__)
-# Secret key for session management
-app.secret_key = os.urandom(24)
+# Secret key for session management. Set SECRET_KEY in production so sessions
+# survive restarts; the random fallback is only suitable for local development.
+app.secret_key = os.environ.get("SECRET_KEY") or os.urandom(24)
 
 DB_PATH = "/tmp/database.db"
+# Match this to the number of worker threads so requests never queue for a connection
+try:
+    POOL_SIZE = max(int(os.environ.get("DB_POOL_SIZE", 5)), 1)
+except ValueError:
+    raise RuntimeError(
+        f"DB_POOL_SIZE must be a positive integer, got {os.environ['DB_POOL_SIZE']!r}"
+    ) from None
+POOL_TIMEOUT = 10  # seconds to wait for a free connection
+STATEMENT_CACHE_SIZE = 256
+SCHEMA_VERSION = 1
+
+LISTINGS_PER_PAGE = 20
+MAX_LISTINGS_PAGE = 10_000  # keeps OFFSET well inside SQLite's integer range
+
+# ─── SQL Statements ───────────────────────────────────────────────────────────
+# Kept as constants so each statement text is identical on every call and is
+# served from sqlite3's per-connection prepared-statement cache.
+
+SQL_GET_USER = "SELECT id, username, email FROM users WHERE id = ?"
+SQL_GET_USER_FOR_LOGIN = "SELECT id, username, password FROM users WHERE email = ?"
+# Needs SQLite 3.35+ for RETURNING; yields no row when username or email is taken
+SQL_INSERT_USER = (
+    "INSERT INTO users (username, email, password) VALUES (?, ?, ?) "
+    "ON CONFLICT DO NOTHING RETURNING id"
+)
+
+SQL_LIST_TASKS = (
+    "SELECT id, title, done, created_at, SUM(done) OVER () AS done_count "
+    "FROM tasks WHERE user_id = ? ORDER BY created_at DESC"
+)
+SQL_INSERT_TASK = "INSERT INTO tasks (user_id, title) VALUES (?, ?) RETURNING id, title, done, created_at"
+SQL_TOGGLE_TASK = (
+    "UPDATE tasks SET done = 1 - done WHERE id = ? AND user_id = ? "
+    "RETURNING id, title, done, created_at"
+)
+SQL_DELETE_TASK = "DELETE FROM tasks WHERE id = ? AND user_id = ?"
+# Actions accepted by /task/<id>/<action>, each a single statement keyed by name
+TASK_ACTIONS = {"toggle": SQL_TOGGLE_TASK, "delete": SQL_DELETE_TASK}
+
+SQL_LIST_LISTINGS = (
+    "SELECT l.id, l.title, l.description, l.price, l.listing_type, l.user_id, l.created_at, u.username, "
+    "COUNT(*) OVER () AS total "
+    "FROM listings l JOIN users u ON l.user_id = u.id ORDER BY l.created_at DESC, l.id DESC LIMIT ? OFFSET ?"
+)
+SQL_COUNT_LISTINGS = "SELECT COUNT(*) FROM listings l JOIN users u ON l.user_id = u.id"
+SQL_INSERT_LISTING = "INSERT INTO listings (user_id, title, description, price, listing_type) VALUES (?, ?, ?, ?, ?)"
+SQL_DELETE_LISTING = "DELETE FROM listings WHERE id = ? AND user_id = ?"
+
+SQL_INSERT_MESSAGE = "INSERT INTO messages (name, email, message) VALUES (?, ?, ?)"
 
 # ─── Database Setup ───────────────────────────────────────────────────────────
 
+class ConnectionPool:
+    """A fixed-size, thread-safe pool of long-lived SQLite connections.
+
+    Connections are opened lazily, so a database that cannot be opened only
+    fails the routes that use it rather than the whole module import.
+    """
+
+    def __init__(self, db_path, size=POOL_SIZE):
+        self.db_path = db_path
+        self.size = size
+        self._pool = queue.Queue(maxsize=size)
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self, timeout):
+        """Returns an idle connection, opening a new one while under `size`."""
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if not can_create:
+            return self._pool.get(timeout=timeout)
+        try:
+            return self._create_connection()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def _create_connection(self):
+        """Opens a connection with the pragmas every request relies on."""
+        conn = sqlite3.connect(
+            self.db_path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE
+        )
+        # Autocommit mode: single statements commit on their own, and routes
+        # that need several statements open an explicit BEGIN IMMEDIATE.
+        conn.isolation_level = None
+        conn.row_factory = sqlite3.Row
+        # page_size only takes effect on a fresh database, so set it before WAL
+        conn.execute("PRAGMA page_size=4096")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=10000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")  # 256 MB of memory-mapped reads
+        conn.execute("PRAGMA analysis_limit=400")  # approximate ANALYZE / optimize
+        return conn
+
+    @contextmanager
+    def connection(self, timeout=POOL_TIMEOUT):
+        """Borrows a connection and hands it back when the block exits."""
+        conn = self._acquire(timeout)
+        try:
+            yield conn
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            try:
+                conn.execute("SELECT 1")
+            except sqlite3.Error:
+                # Broken connection – drop it and free its slot for a fresh one
+                conn.close()
+                with self._lock:
+                    self._created -= 1
+            else:
+                self._pool.put(conn)
+
+    def close(self):
+        """Refreshes planner statistics and closes every idle connection."""
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.execute("PRAGMA optimize")
+            except sqlite3.Error:
+                pass  # Best effort only – e.g. "database is locked" at shutdown
+            finally:
+                conn.close()
+
+pool = ConnectionPool(DB_PATH)
+atexit.register(pool.close)
+
+@contextmanager
 def get_db():
-    """Opens a connection to the SQLite database."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Yields a pooled connection to the SQLite database."""
+    with pool.connection() as conn:
+        yield conn
 
 def init_db():
-    """Creates tables if they don't already exist."""
+    """Creates tables and indexes unless the schema is already current.
+
+    `PRAGMA user_version` records the schema version, so a warm database skips
+    the DDL. Bump SCHEMA_VERSION when the schema changes.
+    """
     with get_db() as db:
-        db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        db.execute("""
-            CREATE TABLE IF NOT EXISTS tasks (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                title TEXT NOT NULL,
-                done INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            )
-        """)
-        db.execute("""
-            CREATE TABLE IF NOT EXISTS listings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                title TEXT NOT NULL,
-                description TEXT,
-                price REAL NOT NULL,
-                listing_type TEXT NOT NULL,  -- 'sell' or 'buy'
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            )
-        """)
-        db.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                email TEXT NOT NULL,
-                message TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        db.commit()
+        if db.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    email TEXT UNIQUE NOT NULL,
+                    password TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    title TEXT NOT NULL,
+                    done INTEGER DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users(id)
+                )
+            """)
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS listings (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    title TEXT NOT NULL,
+                    description TEXT,
+                    price REAL NOT NULL,
+                    listing_type TEXT NOT NULL,  -- 'sell' or 'buy'
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users(id)
+                )
+            """)
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    email TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            # Indexes for the per-user task list and the newest-first marketplace feed
+            db.execute("CREATE INDEX IF NOT EXISTS idx_tasks_user_created ON tasks(user_id, created_at DESC)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_listings_created ON listings(created_at DESC)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_listings_user ON listings(user_id)")
+            db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            db.execute("COMMIT")
+        # Refresh planner statistics on every start: tables are empty when the
+        # schema is first created. analysis_limit keeps this a bounded sample.
+        db.execute("ANALYZE")
 
 # ─── Helper Functions ─────────────────────────────────────────────────────────
 
+SALT_SIZE = 16
+
+def _scrypt(password, salt):
+    return hashlib.scrypt(password.encode(), salt=salt, n=2**14, r=8, p=1, dklen=32)
+
 def hash_password(password):
-    """Hashes a password using SHA-256."""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Hashes a password with salted scrypt, returned as hex `salt || hash`."""
+    salt = os.urandom(SALT_SIZE)
+    return (salt + _scrypt(password, salt)).hex()
+
+def verify_password(password, stored):
+    """Checks a password against a stored hash in constant time."""
+    if len(stored) == 64:
+        # Legacy unsalted SHA-256 hash from before the switch to scrypt
+        candidate = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(candidate, stored)
+    raw = bytes.fromhex(stored)
+    salt, expected = raw[:SALT_SIZE], raw[SALT_SIZE:]
+    return hmac.compare_digest(_scrypt(password, salt), expected)
+
+def current_user_id():
+    """Returns the logged-in user's id from the session, without a DB query."""
+    return session.get("user_id")
 
 def current_user():
-    """Returns the currently logged-in user dict or None."""
-    if "user_id" not in session:
-        return None
-    db = get_db()
-    user = db.execute("SELECT * FROM users WHERE id = ?", (session["user_id"],)).fetchone()
+    """Returns the currently logged-in user dict or None.
+
+    The result (including None) is cached on `g` so the user row is
+    fetched at most once per request.
+    """
+    if hasattr(g, "_cached_user"):
+        return g._cached_user
+    user = None
+    user_id = current_user_id()
+    if user_id is not None:
+        with get_db() as db:
+            user = db.execute(SQL_GET_USER, (user_id,)).fetchone()
+    g._cached_user = user
     return user
 
 def login_required(fn):
     """Decorator that redirects to login page if user is not authenticated."""
-    from functools import wraps
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        if not current_user():
+        if current_user_id() is None:
+            if wants_fragment():
+                # A redirect would be followed by fetch() and the login page
+                # patched into the task list, so let the script reload instead
+                return "", 401
             flash("Iltimos, avval tizimga kiring.", "warning")
             return redirect(url_for("login"))
         return fn(*args, **kwargs)
     return wrapper
 
+def wants_fragment():
+    """True when the dashboard's fetch() script sent the request and expects a partial."""
+    return request.headers.get("X-Requested-With") == "fetch"
+
+# ─── Request Hooks ────────────────────────────────────────────────────────────
+
+@app.before_request
+def reset_user_cache():
+    """Drops any cached user so each request starts fresh."""
+    g.pop("_cached_user", None)
+
 # ─── Context Processor ────────────────────────────────────────────────────────
 
 @app.context_processor
 def inject_user():
-    """Makes `user` available in every template automatically."""
-    return {"user": current_user()}
+    """Makes `user` available in every template automatically.
+
+    Templates only read the id and username, both of which are stored in the
+    session at login, so no query is needed. Sessions created before the
+    username was stored fall back to the database row.
+    """
+    user_id = current_user_id()
+    if user_id is None:
+        return {"user": None}
+    if "username" not in session:
+        return {"user": current_user()}
+    return {"user": {"id": user_id, "username": session["username"]}}
+
+# ─── Static Content ───────────────────────────────────────────────────────────
+# Built once at import; read-only so a template can never mutate shared state.
+
+# Hardcoded sample gadgets for display
+GADGETS = (
+    MappingProxyType({"id": 1, "name": "SmartPhone X12 Pro", "price": 4_599_000, "img": "https://images.unsplash.com/photo-1511707171634-5f897ff02aa9?w=400&q=80", "badge": "Yangi", "rating": 4.8}),
+    MappingProxyType({"id": 2, "name": "AirBuds Neo", "price": 899_000, "img": "https://images.unsplash.com/photo-1505740420928-5e560c06d30e?w=400&q=80", "badge": "Top Sotuv", "rating": 4.6}),
+    MappingProxyType({"id": 3, "name": "4K UltraTab", "price": 3_299_000, "img": "https://images.unsplash.com/photo-1544244015-0df4b3ffc6b0?w=400&q=80", "badge": "Chegirma", "rating": 4.7}),
+    MappingProxyType({"id": 4, "name": "SmartWatch Series 9", "price": 1_450_000, "img": "https://images.unsplash.com/photo-1523275335684-37898b6baf30?w=400&q=80", "badge": "Trend", "rating": 4.9}),
+    MappingProxyType({"id": 5, "name": "NoiseCam 360", "price": 2_100_000, "img": "https://images.unsplash.com/photo-1516035069371-29a1b244cc32?w=400&q=80", "badge": "Yangi", "rating": 4.5}),
+    MappingProxyType({"id": 6, "name": "PowerHub Pro", "price": 650_000, "img": "https://images.unsplash.com/photo-1583394838336-acd977736f90?w=400&q=80", "badge": "Mashhur", "rating": 4.4}),
+)
+
+PLANS = (
+    MappingProxyType({"name": "Bepul", "price": 0, "features": ("5 ta vazifa", "Asosiy do'kon", "Email qo'llab-quvvatlash"), "color": "secondary"}),
+    MappingProxyType({"name": "Pro", "price": 79_000, "features": ("Cheksiz vazifalar", "Bozorga kirish", "24/7 qo'llab-quvvatlash", "Analitika paneli"), "color": "primary", "popular": True}),
+    MappingProxyType({"name": "Biznes", "price": 199_000, "features": ("Hamma Pro imkoniyatlar", "API kirish", "Maxsus menejer", "SLA kafolat"), "color": "dark"}),
+)
 
 # ─── Routes ───────────────────────────────────────────────────────────────────
 
 @app.route("/")
 def index():
     """Home page – showcases gadget cards."""
-    # Hardcoded sample gadgets for display
-    gadgets = [
-        {"id": 1, "name": "SmartPhone X12 Pro", "price": 4_599_000, "img": "https://images.unsplash.com/photo-1511707171634-5f897ff02aa9?w=400&q=80", "badge": "Yangi", "rating": 4.8},
-        {"id": 2, "name": "AirBuds Neo", "price": 899_000, "img": "https://images.unsplash.com/photo-1505740420928-5e560c06d30e?w=400&q=80", "badge": "Top Sotuv", "rating": 4.6},
-        {"id": 3, "name": "4K UltraTab", "price": 3_299_000, "img": "https://images.unsplash.com/photo-1544244015-0df4b3ffc6b0?w=400&q=80", "badge": "Chegirma", "rating": 4.7},
-        {"id": 4, "name": "SmartWatch Series 9", "price": 1_450_000, "img": "https://images.unsplash.com/photo-1523275335684-37898b6baf30?w=400&q=80", "badge": "Trend", "rating": 4.9},
-        {"id": 5, "name": "NoiseCam 360", "price": 2_100_000, "img": "https://images.unsplash.com/photo-1516035069371-29a1b244cc32?w=400&q=80", "badge": "Yangi", "rating": 4.5},
-        {"id": 6, "name": "PowerHub Pro", "price": 650_000, "img": "https://images.unsplash.com/photo-1583394838336-acd977736f90?w=400&q=80", "badge": "Mashhur", "rating": 4.4},
-    ]
-    return render_template("index.html", gadgets=gadgets)
+    return render_template("index.html", gadgets=GADGETS)
 
 @app.route("/about")
 def about():
@@ -124,11 +347,7 @@ def contact():
         message = request.form.get("message", "").strip()
         if name and email and message:
             with get_db() as db:
-                db.execute(
-                    "INSERT INTO messages (name, email, message) VALUES (?, ?, ?)",
-                    (name, email, message)
-                )
-                db.commit()
+                db.execute(SQL_INSERT_MESSAGE, (name, email, message))
             flash("Xabaringiz muvaffaqiyatli yuborildi!", "success")
             return redirect(url_for("contact"))
         else:
@@ -138,49 +357,51 @@ def contact():
 @app.route("/pricing")
 def pricing():
     """Pricing / subscription plans page."""
-    plans = [
-        {"name": "Bepul", "price": 0, "features": ["5 ta vazifa", "Asosiy do'kon", "Email qo'llab-quvvatlash"], "color": "secondary"},
-        {"name": "Pro", "price": 79_000, "features": ["Cheksiz vazifalar", "Bozorga kirish", "24/7 qo'llab-quvvatlash", "Analitika paneli"], "color": "primary", "popular": True},
-        {"name": "Biznes", "price": 199_000, "features": ["Hamma Pro imkoniyatlar", "API kirish", "Maxsus menejer", "SLA kafolat"], "color": "dark"},
-    ]
-    return render_template("pricing.html", plans=plans)
+    return render_template("pricing.html", plans=PLANS)
 
 @app.route("/marketplace", methods=["GET", "POST"])
 @login_required
 def marketplace():
     """Buy/sell listings page – only for authenticated users."""
-    db = get_db()
-    if request.method == "POST":
-        title = request.form.get("title", "").strip()
-        description = request.form.get("description", "").strip()
-        price = request.form.get("price", 0)
-        listing_type = request.form.get("listing_type", "sell")
-        if title and price:
-            db.execute(
-                "INSERT INTO listings (user_id, title, description, price, listing_type) VALUES (?, ?, ?, ?, ?)",
-                (session["user_id"], title, description, float(price), listing_type)
-            )
-            db.commit()
-            flash("E'lon muvaffaqiyatli joylashtirildi!", "success")
-            return redirect(url_for("marketplace"))
-        else:
-            flash("Sarlavha va narx majburiy.", "danger")
+    with get_db() as db:
+        if request.method == "POST":
+            title = request.form.get("title", "").strip()
+            description = request.form.get("description", "").strip()
+            price = request.form.get("price", 0)
+            listing_type = request.form.get("listing_type", "sell")
+            if title and price:
+                db.execute(
+                    SQL_INSERT_LISTING,
+                    (current_user_id(), title, description, float(price), listing_type)
+                )
+                flash("E'lon muvaffaqiyatli joylashtirildi!", "success")
+                return redirect(url_for("marketplace"))
+            else:
+                flash("Sarlavha va narx majburiy.", "danger")
 
-    listings = db.execute(
-        "SELECT l.*, u.username FROM listings l JOIN users u ON l.user_id = u.id ORDER BY l.created_at DESC"
-    ).fetchall()
-    return render_template("marketplace.html", listings=listings)
+        page = min(max(request.args.get("page", 1, type=int), 1), MAX_LISTINGS_PAGE)
+        listings = db.execute(
+            SQL_LIST_LISTINGS, (LISTINGS_PER_PAGE, (page - 1) * LISTINGS_PER_PAGE)
+        ).fetchall()
+        if listings:
+            # The window total is computed before LIMIT, so any row on the page carries it
+            total = listings[0]["total"]
+        elif page > 1:
+            # Past the last page no row carries the total, so count separately
+            total = db.execute(SQL_COUNT_LISTINGS).fetchone()[0]
+        else:
+            total = 0
+    pages = max((total + LISTINGS_PER_PAGE - 1) // LISTINGS_PER_PAGE, 1)
+    if page > pages:
+        return redirect(url_for("marketplace", page=pages))
+    return render_template("marketplace.html", listings=listings, page=page, pages=pages)
 
 @app.route("/marketplace/delete/<int:listing_id>", methods=["POST"])
 @login_required
 def delete_listing(listing_id):
     """Deletes a listing belonging to the current user."""
     with get_db() as db:
-        db.execute(
-            "DELETE FROM listings WHERE id = ? AND user_id = ?",
-            (listing_id, session["user_id"])
-        )
-        db.commit()
+        db.execute(SQL_DELETE_LISTING, (listing_id, current_user_id()))
     flash("E'lon o'chirildi.", "info")
     return redirect(url_for("marketplace"))
 
@@ -189,7 +410,7 @@ def delete_listing(listing_id):
 @app.route("/register", methods=["GET", "POST"])
 def register():
     """User registration route."""
-    if current_user():
+    if current_user_id() is not None:
         return redirect(url_for("dashboard"))
     if request.method == "POST":
         username = request.form.get("username", "").strip()
@@ -204,34 +425,28 @@ def register():
         elif len(password) < 6:
             flash("Parol kamida 6 ta belgidan iborat bo'lishi kerak.", "danger")
         else:
-            try:
-                with get_db() as db:
-                    db.execute(
-                        "INSERT INTO users (username, email, password) VALUES (?, ?, ?)",
-                        (username, email, hash_password(password))
-                    )
-                    db.commit()
+            with get_db() as db:
+                # fetchall() steps the statement to completion so the insert commits
+                inserted = db.execute(SQL_INSERT_USER, (username, email, hash_password(password))).fetchall()
+            if inserted:
                 flash("Ro'yxatdan muvaffaqiyatli o'tdingiz! Iltimos, tizimga kiring.", "success")
                 return redirect(url_for("login"))
-            except sqlite3.IntegrityError:
-                flash("Bu foydalanuvchi nomi yoki email allaqachon mavjud.", "danger")
+            flash("Bu foydalanuvchi nomi yoki email allaqachon mavjud.", "danger")
     return render_template("register.html")
 
 @app.route("/login", methods=["GET", "POST"])
 def login():
     """User login route."""
-    if current_user():
+    if current_user_id() is not None:
         return redirect(url_for("dashboard"))
     if request.method == "POST":
         email = request.form.get("email", "").strip()
         password = request.form.get("password", "")
-        db = get_db()
-        user = db.execute(
-            "SELECT * FROM users WHERE email = ? AND password = ?",
-            (email, hash_password(password))
-        ).fetchone()
-        if user:
+        with get_db() as db:
+            user = db.execute(SQL_GET_USER_FOR_LOGIN, (email,)).fetchone()
+        if user and verify_password(password, user["password"]):
             session["user_id"] = user["id"]
+            session["username"] = user["username"]
             flash(f"Xush kelibsiz, {user['username']}!", "success")
             return redirect(url_for("dashboard"))
         else:
@@ -251,12 +466,10 @@ def logout():
 @login_required
 def dashboard():
     """User dashboard showing their To-Do list."""
-    db = get_db()
-    tasks = db.execute(
-        "SELECT * FROM tasks WHERE user_id = ? ORDER BY created_at DESC",
-        (session["user_id"],)
-    ).fetchall()
-    done_count = sum(1 for t in tasks if t["done"])
+    with get_db() as db:
+        tasks = db.execute(SQL_LIST_TASKS, (current_user_id(),)).fetchall()
+    # Every row carries the same window total, so read it off the first one
+    done_count = tasks[0]["done_count"] if tasks else 0
     return render_template("dashboard.html", tasks=tasks, done_count=done_count)
 
 @app.route("/task/add", methods=["POST"])
@@ -266,38 +479,40 @@ def add_task():
     title = request.form.get("title", "").strip()
     if title:
         with get_db() as db:
-            db.execute(
-                "INSERT INTO tasks (user_id, title) VALUES (?, ?)",
-                (session["user_id"], title)
-            )
-            db.commit()
+            task = db.execute(SQL_INSERT_TASK, (current_user_id(), title)).fetchall()[0]
+        if wants_fragment():
+            return render_template("_task.html", task=task)
     else:
         flash("Vazifa matni bo'sh bo'lishi mumkin emas.", "warning")
+        if wants_fragment():
+            return "", 400
     return redirect(url_for("dashboard"))
 
-@app.route("/task/toggle/<int:task_id>", methods=["POST"])
+@app.route("/task/<int:task_id>/<action>", methods=["POST"])
 @login_required
-def toggle_task(task_id):
-    """Toggles a task's done/undone status."""
+def update_task(task_id, action):
+    """Toggles or deletes a task belonging to the current user."""
+    sql = TASK_ACTIONS.get(action)
+    if sql is None:
+        abort(400)
     with get_db() as db:
-        db.execute(
-            "UPDATE tasks SET done = 1 - done WHERE id = ? AND user_id = ?",
-            (task_id, session["user_id"])
-        )
-        db.commit()
+        rows = db.execute(sql, (task_id, current_user_id())).fetchall()
+    if wants_fragment():
+        if action == "delete":
+            return "", 204
+        return render_template("_task.html", task=rows[0]) if rows else ("", 404)
     return redirect(url_for("dashboard"))
 
-@app.route("/task/delete/<int:task_id>", methods=["POST"])
-@login_required
-def delete_task(task_id):
-    """Deletes a task belonging to the current user."""
+# ─── Maintenance ──────────────────────────────────────────────────────────────
+
+@app.cli.command("vacuum-db")
+def vacuum_db():
+    """Compacts the database and re-runs ANALYZE; run weekly from cron."""
     with get_db() as db:
-        db.execute(
-            "DELETE FROM tasks WHERE id = ? AND user_id = ?",
-            (task_id, session["user_id"])
-        )
-        db.commit()
-    return redirect(url_for("dashboard"))
+        db.execute("VACUUM")
+        # ANALYZE rather than PRAGMA optimize: a fresh connection's optimize only
+        # considers tables it has already queried, so it would skip everything
+        db.execute("ANALYZE")
 
 # ─── Entry Point ──────────────────────────────────────────────────────────────
 